@@ -1,9 +1,15 @@
-from attr import dataclass
+from dataclasses import dataclass
 
-@dataclass
+@dataclass(slots=True)
 class ZeroBasePubConfig:
     """
     This represents the configuration for a ZeroBase publisher socket.
     """
 
-    addr: str
\ No newline at end of file
+    addr: str
+
+    # ZMQ socket options, applied before binding
+    sndhwm: int = 1000
+    linger: int = 0
+    tcp_keepalive: int = 1
+    immediate: int = 1
\ No newline at end of file
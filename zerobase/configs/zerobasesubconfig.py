@@ -1,12 +1,16 @@
 from typing import List
-from attr import dataclass
+from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True)
 class ZeroBaseSubConfig:
     """
     This represents the configuration for a ZeroBase subscriber socket.
     """
 
     addr: str
-    topics: List[str]
\ No newline at end of file
+    topics: List[str]
+
+    # ZMQ socket options, applied before connecting
+    rcvhwm: int = 1000
+    linger: int = 0
\ No newline at end of file
@@ -0,0 +1 @@
+from .zerobaseepollpoller import ZeroBaseEpollPoller
\ No newline at end of file
@@ -0,0 +1,95 @@
+import select
+import threading
+import zmq
+
+from typing import Dict, List, Tuple
+
+
+class ZeroBaseEpollPoller:
+    """
+    This represents an epoll-backed poller for ZeroBase, used instead of zmq.Poller when a lot of sockets are registered.
+
+    It mirrors the zmq.Poller interface, but each socket's file descriptor is only registered once with the kernel, and only the sockets that actually woke up are checked after each poll.
+    """
+
+    def __init__(self) -> None:
+        self._epoll = select.epoll()
+        self._fd_sockets: Dict[int, zmq.Socket] = {}
+
+        # ZMQ file descriptors are edge-triggered, so sockets that were ready on the last poll (or that were just registered)
+        # could still have queued messages without their file descriptor ever waking up again
+        self._pending: List[zmq.Socket] = []
+
+        # sockets can be registered from other threads while polling, so they're queued separately & merged in by poll()
+        self._registered: List[zmq.Socket] = []
+        self._registered_lock = threading.Lock()
+
+    @staticmethod
+    def is_supported() -> bool:
+        """
+        Whether epoll is available on this platform (only on Linux).
+        """
+
+        return hasattr(select, "epoll")
+
+    @property
+    def sockets(self) -> List[Tuple[zmq.Socket, int]]:
+        return [(socket, zmq.POLLIN) for socket in self._fd_sockets.values()]
+
+    def register(self, socket: zmq.Socket, flags: int = zmq.POLLIN) -> None:
+        """
+        Registers a socket for incoming messages (only POLLIN is supported).
+        """
+
+        fd = socket.getsockopt(zmq.FD)
+
+        self._epoll.register(fd, select.EPOLLIN)
+        self._fd_sockets[fd] = socket
+
+        with self._registered_lock:
+            self._registered.append(socket)
+
+    def unregister(self, socket: zmq.Socket) -> None:
+        """
+        Unregisters a previously registered socket.
+        """
+
+        fd = socket.getsockopt(zmq.FD)
+
+        self._epoll.unregister(fd)
+        self._fd_sockets.pop(fd, None)
+
+        with self._registered_lock:
+            if socket in self._registered:
+                self._registered.remove(socket)
+
+        if socket in self._pending:
+            self._pending.remove(socket)
+
+    def poll(self, timeout: int | None = None) -> List[Tuple[zmq.Socket, int]]:
+        """
+        Polls the registered sockets, returning a list of (socket, zmq.POLLIN) tuples for every ready socket. The timeout is in milliseconds, like zmq.Poller.
+        """
+
+        with self._registered_lock:
+            registered, self._registered = self._registered, []
+
+        ready = [socket for socket in self._pending + registered if socket.getsockopt(zmq.EVENTS) & zmq.POLLIN]
+
+        # don't block if any of the previously ready sockets still have messages, but still check the others so they don't starve
+        for fd, _ in self._epoll.poll(0 if ready else (-1 if timeout is None else timeout / 1000)):
+            socket = self._fd_sockets.get(fd)
+
+            if socket is not None and socket not in ready and socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                ready.append(socket)
+
+        self._pending = ready
+
+        return [(socket, zmq.POLLIN) for socket in ready]
+
+    def close(self) -> None:
+        """
+        Closes the underlying epoll file descriptor.
+        """
+
+        self._epoll.close()
\ No newline at end of file
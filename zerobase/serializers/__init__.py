@@ -0,0 +1 @@
+from .zerobaseserializer import ZeroBaseSerializer
\ No newline at end of file
@@ -0,0 +1,118 @@
+import msgpack
+import pickle
+
+from typing import Any, List
+
+# numpy & blosc are optional, they're only used (when both are installed) to compress numpy arrays
+try:
+    import blosc
+    import numpy
+except ImportError:
+    blosc = None
+    numpy = None
+
+
+class ZeroBaseSerializer:
+    """
+    This represents the serializer used by ZeroBase to encode and decode message payloads.
+
+    MessagePack is used by default, since it's much faster than pickle for the small, primitive messages that are usually sent around. Pickle can still be selected explicitly when arbitrary Python objects need to be sent.
+
+    If numpy and blosc are installed, numeric numpy arrays are compressed with blosc (with byte shuffling), which is usually faster end-to-end than sending them uncompressed.
+
+    Every payload starts with a 1-byte tag of the format it was serialized with, so the formats can be told apart when decoding. Pickled payloads are only decoded when pickle was selected, since unpickling untrusted data can run arbitrary code.
+    """
+
+    MSGPACK = "msgpack"
+    PICKLE = "pickle"
+
+    MSGPACK_TAG = b"M"
+    PICKLE_TAG = b"P"
+    NDARRAY_TAG = b"N"
+
+    # buffers (like bytearrays or numpy arrays) at least this big are pickled out-of-band, so that they're sent as-is in their own frames
+    OOB_BUFFER_MIN_SIZE = 64 * 1024
+
+    # numpy dtype kinds that are compressed with blosc (booleans, integers, floats & complex numbers)
+    NDARRAY_KINDS = "biufc"
+
+    # byte length of the size of the dtype & shape header that's placed in front of a compressed numpy array
+    NDARRAY_HEADER_SIZE_LEN = 2
+
+    def __init__(self, serial: str = MSGPACK) -> None:
+        if serial not in (self.MSGPACK, self.PICKLE):
+            raise ValueError("Unknown serializer \"" + serial + "\", must be one of: " + str([self.MSGPACK, self.PICKLE]))
+
+        self.serial = serial
+
+    def dumps(self, msg: Any, prefix: bytes = b"", buffers: List[memoryview] | None = None) -> bytes:
+        """
+        Serializes the given message into tagged bytes, placed right after the given prefix (so that they're only concatenated once).
+
+        If a buffers list is given, pickle (protocol 5) adds any large buffers in the message to it instead of copying them into the returned bytes. They must then be passed to loads() along with them. These buffers point to the message's own memory, so they must be copied before the message can change.
+        """
+
+        # only exact ndarrays, since subclasses (like masked arrays) would lose whatever they add on top
+        if blosc is not None and type(msg) is numpy.ndarray and msg.dtype.kind in self.NDARRAY_KINDS:
+            # contiguous arrays are compressed straight from their memory, only the others have to be copied into contiguous bytes first
+            data = memoryview(msg).cast("B") if msg.flags.c_contiguous else msg.tobytes()
+            compressed = blosc.compress(data, typesize=msg.itemsize, cname="lz4", shuffle=blosc.SHUFFLE)
+
+            # the dtype & shape go in a small header in front of the compressed data (so that the data itself isn't copied into it)
+            header = msgpack.packb((msg.dtype.str, msg.shape), use_bin_type=True)
+
+            return b"".join((prefix, self.NDARRAY_TAG, len(header).to_bytes(self.NDARRAY_HEADER_SIZE_LEN, "little"), header, compressed))
+
+        if self.serial == self.PICKLE:
+            if buffers is None:
+                return b"".join((prefix, self.PICKLE_TAG, pickle.dumps(msg, protocol=5)))
+
+            return b"".join((prefix, self.PICKLE_TAG, pickle.dumps(msg, protocol=5, buffer_callback=lambda buffer: self._add_oob_buffer(buffer, buffers))))
+
+        return b"".join((prefix, self.MSGPACK_TAG, msgpack.packb(msg, use_bin_type=True)))
+
+    def loads(self, data: bytes | memoryview, buffers: List[memoryview] | None = None) -> Any:
+        """
+        Deserializes the given tagged bytes (or any bytes-like object) back into a message, along with any out-of-band buffers that dumps() produced for it.
+        """
+
+        tag = data[:1]
+        payload = data[1:]
+
+        if tag == self.MSGPACK_TAG:
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+        if tag == self.PICKLE_TAG:
+            # unpickling can run arbitrary code, so it's only done when pickle was opted into on this side too
+            if self.serial != self.PICKLE:
+                raise ValueError("Received a pickled message, but the serializer isn't \"" + self.PICKLE + "\"")
+
+            return pickle.loads(payload, buffers=buffers)
+
+        if tag == self.NDARRAY_TAG:
+            if blosc is None:
+                raise ValueError("Received a numpy array, but numpy or blosc isn't installed")
+
+            payload = memoryview(payload)
+
+            header_end = self.NDARRAY_HEADER_SIZE_LEN + int.from_bytes(payload[:self.NDARRAY_HEADER_SIZE_LEN], "little")
+            dtype, shape = msgpack.unpackb(payload[self.NDARRAY_HEADER_SIZE_LEN:header_end], raw=False)
+
+            # decompressed into a bytearray, so that the array is writable
+            return numpy.frombuffer(blosc.decompress(payload[header_end:], as_bytearray=True), dtype=dtype).reshape(shape)
+
+        raise ValueError("Unknown serializer tag: " + str(bytes(tag)))
+
+    # pickle's buffer callback, returns whether the buffer should stay in-band (small or non-contiguous buffers)
+    def _add_oob_buffer(self, buffer: pickle.PickleBuffer, buffers: List[memoryview]) -> bool:
+        try:
+            raw_buffer = buffer.raw()
+        except BufferError:
+            return True
+
+        if raw_buffer.nbytes < self.OOB_BUFFER_MIN_SIZE:
+            return True
+
+        buffers.append(raw_buffer)
+
+        return False
\ No newline at end of file
@@ -1,10 +1,10 @@
 import zmq
 
-from attr import dataclass
+from dataclasses import dataclass
 
 from ..configs import ZeroBasePubConfig
 
-@dataclass
+@dataclass(slots=True)
 class ZeroBasePubSocket:
     """
     This represents a ZeroBase publisher socket.
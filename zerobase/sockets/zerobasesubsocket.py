@@ -1,15 +1,14 @@
 import zmq
 
-from attr import dataclass
+from dataclasses import dataclass
 
 from ..configs import ZeroBaseSubConfig
 
-@dataclass
+@dataclass(slots=True)
 class ZeroBaseSubSocket:
     """
     This represents a ZeroBase subscriber socket.
     """
 
     socket: zmq.Socket
-    config: ZeroBaseSubConfig
-    registered: bool = False
\ No newline at end of file
+    config: ZeroBaseSubConfig
\ No newline at end of file
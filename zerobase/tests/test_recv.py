@@ -1,14 +1,17 @@
-import pickle
 import zmq
 import signal
 
+from zerobase import ZeroBaseSerializer
+
 signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+serializer = ZeroBaseSerializer()
+
 ctx = zmq.Context() 
 socket = ctx.socket(zmq.SUB)
 socket.connect("tcp://localhost:5556")
 socket.setsockopt_string(zmq.SUBSCRIBE, "")
 
 while True:
-    print("Message received: " + str(pickle.loads(socket.recv_multipart().pop())))
+    print("Message received: " + str(serializer.loads(socket.recv().split(b"\x00", 1).pop())))
     pass
\ No newline at end of file
@@ -1,3 +1,4 @@
+import msgpack
 import time
 import zmq
 
@@ -6,8 +7,7 @@ socket = ctx.socket(zmq.PUB)
 socket.bind("tcp://*:5555")
 
 while True:
-    socket.send(bytes("", "utf-8"), zmq.SNDMORE)
     print("Sending message: Hello, World!")
-    socket.send_pyobj("Hello, World!")
+    socket.send(bytes("", "utf-8") + b"\x00" + b"M" + msgpack.packb("Hello, World!"))
     time.sleep(2)
     pass
\ No newline at end of file
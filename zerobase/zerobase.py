@@ -7,14 +7,19 @@ Copyright 2023, NanoStride
 GPLv3 License. All rights reserved.
 """
 
-import pickle
+import gc
+import os
+import queue
 import sys
 import threading
+import time
 import zmq
 import signal
 
-from typing import Any, Callable, List
+from typing import Any, Callable, Dict, List, Tuple
 from .configs import ZeroBasePubConfig, ZeroBaseSubConfig
+from .pollers import ZeroBaseEpollPoller
+from .serializers import ZeroBaseSerializer
 from .sockets import ZeroBasePubSocket, ZeroBaseSubSocket
 
 
@@ -23,12 +28,49 @@ class ZeroBase():
     This is the base class for all ZeroMQ-based programs for NanoStride. It handles all of the necessary setup and teardown for ZeroMQ, and provides a simple interface for sending and receiving messages.
     """
 
-    def __init__(self, main: Callable[[], bool], msg_received: Callable[[str, Any], None], logger: Callable[[Any], None] = print) -> None:
+    # amount of SUB sockets above which the epoll-backed poller is used instead of zmq.Poller (if the platform supports it)
+    EPOLL_SOCKET_THRESHOLD = 100
+
+    # how long (in ms) each poll can block for, so that the receive loop can notice when it has been stopped
+    POLL_TIMEOUT_MS = 100
+
+    # max amount of messages received from a single socket per poll, so that a busy socket can't starve the others
+    MAX_BATCH_SIZE = 1000
+
+    # max amount of received messages waiting for the workers, past that the receive loop waits (and ZMQ's RCVHWM takes over)
+    MSG_QUEUE_SIZE = 1000
+
+    # GC gen0 threshold used while decoding a large batch of messages (instead of the default few hundred allocations)
+    GC_DECODE_THRESHOLD = 100_000
+
+    # amount of messages drained from a socket before the GC threshold gets raised (small wakeups aren't worth the overhead)
+    GC_DECODE_MIN_BATCH_SIZE = 16
+
+    # separates the topic from the payload, since both are sent in a single frame (topics can't contain it)
+    TOPIC_SEPARATOR = b"\x00"
+
+    def __init__(self, main: Callable[[], bool], msg_received: Callable[[str, Any], None], logger: Callable[[Any], None] = print, serializer: str = ZeroBaseSerializer.MSGPACK, msg_workers: int = 1, io_threads: int | None = None, main_period_s: float | None = None) -> None:
         # assign callback properties
         self._main = main
         self._logger = logger
         self._msg_received = msg_received
 
+        # messages are serialized with msgpack by default, pickle has to be explicitly requested for arbitrary objects
+        self._serializer = ZeroBaseSerializer(serializer)
+
+        # received messages are handed off to worker threads, so that a slow callback doesn't stall the receive loop
+        # (with more than one worker, messages can be handled concurrently and out of order, with none they're handled by the receive loop itself)
+        self._msg_workers = max(0, msg_workers)
+
+        # if set, run() calls main at this period (in seconds), even if main doesn't sleep on its own
+        self._main_period_s = main_period_s
+
+        # amount of ZMQ IO threads, sized from the amount of sockets on init if not given
+        self._io_threads = io_threads
+
+        # encoded topic prefixes (topic + separator), so that they aren't re-encoded on every send
+        self._topic_cache: Dict[str, bytes] = {}
+
         self.has_init = False
 
     def init(self, pub_configs: List[ZeroBasePubConfig] | None, sub_configs: List[ZeroBaseSubConfig] = []) -> None:
@@ -42,32 +84,68 @@ class ZeroBase():
         self._logger("Initializing ZeroBase...")
 
         # initialize ZMQ & ZeroBase properties
-        self._ctx = zmq.Context()
+        pub_configs = pub_configs or []
+
+        # a single IO thread handles all TCP traffic by default, so use one for every 4 sockets, up to one per core (unless set explicitly,
+        # 0 included, which is valid for inproc-only setups)
+        if self._io_threads is not None:
+            io_threads = self._io_threads
+        else:
+            io_threads = min(os.cpu_count() or 1, max(1, (len(pub_configs) + len(sub_configs)) // 4))
+
+        self._ctx = zmq.Context(io_threads=io_threads)
         self.pub_sockets: List[ZeroBasePubSocket] = []
         self.sub_sockets: List[ZeroBaseSubSocket] = []
+        self._has_subs_cv = threading.Condition()
+
+        # zmq.Poller is fine for a handful of sockets, but with a lot of them it's better to only look at the ones that actually woke up
+        if len(sub_configs) > self.EPOLL_SOCKET_THRESHOLD and ZeroBaseEpollPoller.is_supported():
+            self._poller = ZeroBaseEpollPoller()
+        else:
+            self._poller = zmq.Poller()
 
         # initialize PUB sockets
         for config in pub_configs:
             socket = self._ctx.socket(zmq.PUB)
+            socket.setsockopt(zmq.SNDHWM, config.sndhwm)
+            socket.setsockopt(zmq.LINGER, config.linger)
+            socket.setsockopt(zmq.TCP_KEEPALIVE, config.tcp_keepalive)
+            socket.setsockopt(zmq.IMMEDIATE, config.immediate)
             socket.bind(config.addr)
 
             self.pub_sockets.append(ZeroBasePubSocket(socket, config))
 
         # initialize SUB sockets
+        self._logger("Registering sockets...")
+
         for config in sub_configs:
-            socket = self._ctx.socket(zmq.SUB)
-            socket.connect(config.addr)
+            self._add_sub_socket(config)
+
+        self._logger("Registered sockets: " + str(len(self.sub_sockets)))
+
+        # must be set before starting the thread, otherwise the receive loop might exit right away
+        self.has_init = True
 
-            for topic in config.topics:
-                socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+        # start the message worker threads
+        self._msg_queue = queue.Queue(maxsize=self.MSG_QUEUE_SIZE)
+        self._msg_worker_threads = [threading.Thread(target=self._msg_worker) for _ in range(self._msg_workers)]
 
-            self.sub_sockets.append(ZeroBaseSubSocket(socket, config))
+        for msg_worker_thread in self._msg_worker_threads:
+            msg_worker_thread.start()
 
         # start the communication loop thread
         self._receive_loop_thread = threading.Thread(target=self._receive_loop)
         self._receive_loop_thread.start()
 
-        self.has_init = True
+    def add_sub_config(self, config: ZeroBaseSubConfig) -> None:
+        """
+        Adds a new subscriber socket after initialization. The receive loop will start listening to it on its next poll.
+        """
+
+        if not self.has_init:
+            return
+
+        self._add_sub_socket(config)
 
     def run(self) -> None:
         """ 
@@ -79,11 +157,23 @@ class ZeroBase():
         if self._main is None:
             return
 
+        next_deadline = time.monotonic()
+
         # run the main loop until it returns false (indicating that the program should stop) or the program is terminated
         while self.has_init:
             if not self._main():
                 break
 
+            if self._main_period_s:
+                next_deadline += self._main_period_s
+                sleep_for = next_deadline - time.monotonic()
+
+                # if main took longer than the period, start over from now instead of trying to catch up
+                if sleep_for > 0:
+                    time.sleep(sleep_for)
+                else:
+                    next_deadline = time.monotonic()
+
         self.uninit()
 
     def uninit(self) -> None:
@@ -98,16 +188,33 @@ class ZeroBase():
 
         self.has_init = False
 
+        # wake the receive loop up, in case it's waiting for SUB sockets
+        with self._has_subs_cv:
+            self._has_subs_cv.notify_all()
+
         # wait for the receive loop thread to finish, kill it if it's taking too long
         if self._receive_loop_thread is not None:
             self._receive_loop_thread.join(timeout=2)
-        
+
+        # wake up any idle workers so they can stop (busy ones stop after their current message, dropping what's left in the queue)
+        for _ in self._msg_worker_threads:
+            try:
+                self._msg_queue.put_nowait(None)
+            except queue.Full:
+                break
+
+        for msg_worker_thread in self._msg_worker_threads:
+            msg_worker_thread.join(timeout=2)
+
         for pub_socket in self.pub_sockets:
             pub_socket.socket.close()
 
         for sub_socket in self.sub_sockets:
             sub_socket.socket.close()
 
+        if isinstance(self._poller, ZeroBaseEpollPoller):
+            self._poller.close()
+
         self.pub_sockets.clear()
         self.sub_sockets.clear()
 
@@ -123,68 +230,193 @@ class ZeroBase():
 
         self._logger("Sending message " + str(msg) + " on topic: \"" + topic + "\"")
 
+        topic_prefix = self._topic_cache.get(topic)
+
+        if topic_prefix is None:
+            topic_prefix = self._encode_topic(topic)
+
+        # the topic is sent as a prefix of the payload (instead of in its own frame), ZMQ subscriptions still match on it
+        # (it's only serialized once, no matter how many publishers it goes through)
+        buffers: List[memoryview] = []
+        payload = self._serializer.dumps(msg, topic_prefix, buffers)
+
+        # out-of-band buffers point to the caller's own memory, which ZMQ would only read after send() returns,
+        # so they're copied once here (for all publishers) to send what the message held at the time of the call
+        if buffers:
+            buffers = [bytes(buffer) for buffer in buffers]
+
         # send the same message, if the socket has been opened, through all supplied publishers
+        # (without copying it into ZMQ, which is safe since everything sent is immutable bytes)
+        # (pyzmq still copies anything under its copy threshold, since that's faster for small messages)
         for pub_socket in self.pub_sockets:
-            pub_socket.socket.send(bytes(topic, "utf-8"), zmq.SNDMORE)
-            pub_socket.socket.send_pyobj(msg)
+            # large pickled buffers go out-of-band, in their own frames after the payload
+            if buffers:
+                pub_socket.socket.send_multipart([payload, *buffers], copy=False, track=False)
+            else:
+                pub_socket.socket.send(payload, copy=False, track=False)
 
-    # receive a message from the specified topic
+    # encodes the topic prefix for the given topic and caches it
+    def _encode_topic(self, topic: str) -> bytes:
+        topic_bytes = topic.encode("utf-8")
 
-    def _receive_loop(self) -> None:
-        poller = zmq.Poller()
+        if self.TOPIC_SEPARATOR in topic_bytes:
+            raise ValueError("Topic \"" + topic + "\" can't contain null characters")
 
-        self._logger("Registering sockets...")
+        topic_prefix = topic_bytes + self.TOPIC_SEPARATOR
+        self._topic_cache[topic] = topic_prefix
 
-        for sub_socket in self.sub_sockets:
-            self._logger("Registering sub socket on address " + sub_socket.config.addr +
-                         " with topics: " + str(sub_socket.config.topics))
+        return topic_prefix
+
+    # creates a SUB socket for the given config and registers it with the poller
+    def _add_sub_socket(self, config: ZeroBaseSubConfig) -> None:
+        socket = self._ctx.socket(zmq.SUB)
+        socket.setsockopt(zmq.RCVHWM, config.rcvhwm)
+        socket.setsockopt(zmq.LINGER, config.linger)
+        socket.connect(config.addr)
+
+        for topic in config.topics:
+            socket.setsockopt(zmq.SUBSCRIBE, topic.encode("utf-8"))
 
-            poller.register(sub_socket.socket, zmq.POLLIN)
-            sub_socket.registered = True
+        sub_socket = ZeroBaseSubSocket(socket, config)
 
-        self.registered_sub_qty = len(self.sub_sockets)
+        self._logger("Registering sub socket on address " + config.addr +
+                     " with topics: " + str(config.topics))
 
-        self._logger("Registered sockets: " + str(self.registered_sub_qty))
+        # the receive loop might be polling at the same time, so the socket list & the poller have to be updated together
+        with self._has_subs_cv:
+            self.sub_sockets.append(sub_socket)
+            self._poller.register(socket, zmq.POLLIN)
+
+            self._has_subs_cv.notify_all()
+
+    # receive messages from all the registered SUB sockets
+    def _receive_loop(self) -> None:
         self._logger("ZeroBase receive loop started!")
 
+        # the poller doesn't change after init, so avoid looking these up on every iteration
+        poll = self._poller.poll
+        process_poll = self._process_poll
+        poll_timeout_ms = self.POLL_TIMEOUT_MS
+
         # run the comms loop
         while self.has_init:
-            # check if any sockets have been registered (otherwise, there's no point in trying to receive messages)
-            if len(poller.sockets) == 0:
-                continue
-
-            # register any new sockets
-            if self.registered_sub_qty <= len(self.sub_sockets):
-                for sub_socket in filter(lambda socket: (not socket.registered), self.sub_sockets):
-                    poller.register(sub_socket.socket, zmq.POLLIN)
-                    sub_socket.registered = True
+            # wait until any sockets have been registered (otherwise, there's no point in trying to receive messages)
+            if not self.sub_sockets:
+                with self._has_subs_cv:
+                    while self.has_init and not self.sub_sockets:
+                        self._has_subs_cv.wait()
 
-                self.registered_sub_qty = len(self.sub_sockets)
+                continue
 
-            # poll for any messages
+            # poll for any messages (with a timeout, so that the loop can stop)
             try:
-                ready_sockets = dict(poller.poll())
+                events = poll(poll_timeout_ms)
 
-                self._process_poll(ready_sockets)
+                process_poll(events)
             except:
                 # if the message can't be received, just ignore it
                 continue
 
-    # processes the ZMQ polling results
-    def _process_poll(self, ready_sockets: dict[Any, int]) -> None:
-        for sub_socket in self.sub_sockets:
-            # not super sure why I can't use the socket that was returned by the poller, but it doesn't work for some reason
-            # this is just following the example from the ZeroMQ guide
-            if sub_socket.socket not in ready_sockets:
+    # processes the ZMQ polling results (only the sockets that are ready are returned by the poller)
+    def _process_poll(self, events: List[Tuple[zmq.Socket, int]]) -> None:
+        # everything used per message is looked up once per poll, so that the loop below only touches locals
+        separator = self.TOPIC_SEPARATOR
+        loads = self._serializer.loads
+        put_msg = self._put_msg if self._msg_workers else None
+        handle_msg = self._handle_msg
+        has_msg_received = self._msg_received is not None
+        max_batch_size = self.MAX_BATCH_SIZE
+        gc_min_batch_size = self.GC_DECODE_MIN_BATCH_SIZE
+
+        for socket, _ in events:
+            # stop between batches if the loop has been stopped, since the sockets are about to be closed
+            if not self.has_init:
+                return
+
+            recv_batch: List[Tuple[str, Any]] = []
+
+            # deserializing allocates lots of small objects, which would otherwise keep triggering gen0 collections while draining a burst
+            # (so once a batch gets large, the gen0 threshold is raised until it's decoded, if it's lower & not 0; the threshold is
+            # process-wide though, so the msg workers & any other threads also run with it raised in the meantime)
+            gc_thresholds = None
+            gc_raised = False
+
+            try:
+                # drain up to a batch of what's queued on the socket, so that bursts don't need a poll per message
+                # (anything left over is picked up on the next poll, after the other sockets had their turn)
+                for recv_count in range(max_batch_size):
+                    if recv_count == gc_min_batch_size:
+                        gc_thresholds = gc.get_threshold()
+                        gc_raised = 0 < gc_thresholds[0] < self.GC_DECODE_THRESHOLD
+
+                        if gc_raised:
+                            gc.set_threshold(self.GC_DECODE_THRESHOLD, *gc_thresholds[1:])
+
+                    try:
+                        recv_msg = socket.recv(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+
+                    # any frames after the first one are out-of-band pickle buffers (received without copying, since they're large)
+                    recv_buffers = None
+
+                    if socket.rcvmore:
+                        recv_buffers = []
+
+                        while socket.rcvmore:
+                            recv_buffers.append(socket.recv(copy=False).buffer)
+
+                    # nobody's listening, so there's no point in deserializing the message
+                    if not has_msg_received:
+                        continue
+
+                    # splits the topic from the message at the first separator, and deserializes the message
+                    # (through a memoryview, so that the payload isn't copied into a new bytes object first)
+                    try:
+                        separator_idx = recv_msg.index(separator)
+
+                        recv_topic = recv_msg[:separator_idx].decode("utf-8")
+                        recv_obj = loads(memoryview(recv_msg)[separator_idx + 1:], recv_buffers)
+                    except Exception as e:
+                        # skip just this message (e.g. sent with an optional serializer that isn't installed here)
+                        self._logger("Error while deserializing message: " + str(e))
+                        continue
+
+                    recv_batch.append((recv_topic, recv_obj))
+            finally:
+                if gc_raised:
+                    gc.set_threshold(*gc_thresholds)
+
+            # hand the messages off to the workers, or handle them right away if there aren't any (with the GC threshold restored)
+            for msg in recv_batch:
+                if put_msg is not None:
+                    put_msg(msg)
+                else:
+                    handle_msg(*msg)
+
+    # queues a message for the workers, waiting while the queue is full so that the backpressure reaches ZMQ
+    def _put_msg(self, msg: Tuple[str, Any]) -> None:
+        while self.has_init:
+            try:
+                self._msg_queue.put(msg, timeout=self.POLL_TIMEOUT_MS / 1000)
+
+                return
+            except queue.Full:
                 continue
 
-            recv_msg = sub_socket.socket.recv_multipart()
+    # calls the message callback for every received message, until it gets a None or the instance is stopped
+    def _msg_worker(self) -> None:
+        while True:
+            msg = self._msg_queue.get()
+
+            if msg is None or not self.has_init:
+                break
 
-            # tries to manually deserialize the received message (because the first frame is the topic)
-            # the first frame is the topic, and the second is the message
-            recv_topic = recv_msg.pop(0).decode("utf-8")
-            recv_obj = recv_msg.pop()
-            recv_obj = pickle.loads(recv_obj)
+            self._handle_msg(*msg)
 
-            # call the callback if it exists
-            self._msg_received(recv_topic, recv_obj)
\ No newline at end of file
+    # calls the message callback, logging any errors it raises instead of letting them stop the calling loop
+    def _handle_msg(self, topic: str, obj: Any) -> None:
+        try:
+            self._msg_received(topic, obj)
+        except Exception as e:
+            self._logger("Error while handling message on topic \"" + topic + "\": " + str(e))
\ No newline at end of file